@@ -1,19 +1,36 @@
 """Main entry point for the LLM PostGIS Assistant FastAPI application."""
 
+import logging
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from app.routers import dbcheck, chat
-from db.schema_cache import load_schema_cache
-
-ALLOWED_SCHEMAS = ["public", "datos_crudos", "datos_maestros", "medio_fisico", "specimen"]
+from core.config import ALLOWED_SCHEMAS, settings
+from db.engine import engine
+from db.schema_cache import load_schema_cache, load_schema_cache_file
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    """Lifespan event handler to load the schema cache at startup."""
-    load_schema_cache(ALLOWED_SCHEMAS)
+    """Lifespan event handler to load the schema cache at startup.
+
+    If SCHEMA_CACHE_FILE is set, uses the fresh snapshot written by scripts/warm_cache.py,
+    so N workers don't each query the catalog; otherwise loads from the database.
+    """
+    log = logging.getLogger(__name__)
+    path = settings.SCHEMA_CACHE_FILE
+    if path and load_schema_cache_file(path, ALLOWED_SCHEMAS, settings.SCHEMA_CACHE_MAX_AGE):
+        log.info("Catálogo cargado desde el snapshot %s", path)
+    else:
+        await load_schema_cache(ALLOWED_SCHEMAS)
+        log.info("Catálogo cargado desde la base de datos")
     yield
+    await engine.dispose()
 
-app = FastAPI(title="LLM PostGIS Assistant", lifespan=lifespan)
+app = FastAPI(
+    title="LLM PostGIS Assistant",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.include_router(dbcheck.router, prefix="/api")
 app.include_router(chat.router,   prefix="/api")
\ No newline at end of file
@@ -1,17 +1,18 @@
 # app/routers/chat.py
 from __future__ import annotations
 
+import asyncio
 from typing import Optional
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 
-from safeguards.sql_parser import is_safe_sql
+from safeguards.sql_parser import is_safe_sql, parse_sql
 from db.explain_gate import explain_summary, too_expensive
 from db.engine import run_query_secure
 from db.introspect import build_schema_ctx, find_table_refs
 from db.sql_fixup import fix_sql
 
-from llm.prompts import build_sql_prompt
+from llm.prompts import build_sql_prompt_parts
 from llm.client_llamacpp import infer_sql, infer_chat
 
 router = APIRouter()
@@ -21,8 +22,11 @@ class ChatIn(BaseModel):
     sql: Optional[str] = None
     execute: bool = True
 
+async def _no_rows() -> list:
+    return []
+
 @router.post("/chat")
-def chat(in_: ChatIn):
+async def chat(in_: ChatIn):
     if not in_.sql and not in_.question:
         raise HTTPException(status_code=400, detail="Proporciona 'sql' o 'question'.")
 
@@ -39,8 +43,10 @@ def chat(in_: ChatIn):
             refs_hint = "\n\nTABLAS_MENCIONADAS:\n" + "\n".join(f"{s}.{t}" for s, t in refs)
 
         schema_ctx = build_schema_ctx((in_.question or "") + refs_hint)
-        prompt = build_sql_prompt(in_.question, schema_ctx=schema_ctx)
-        sql_block = infer_sql(prompt)
+        # Prefijo estático (KV-cache reutilizable) + parte dinámica por pregunta
+        static_prefix, prompt = build_sql_prompt_parts(in_.question, schema_ctx=schema_ctx)
+        # llama.cpp es CPU-bound: fuera del event loop
+        sql_block = await asyncio.to_thread(infer_sql, prompt, static_prefix)
         sql = (sql_block or "").strip()
         if sql.startswith("```sql"):
             sql = sql.replace("```sql", "").replace("```", "").strip()
@@ -50,18 +56,20 @@ def chat(in_: ChatIn):
     if not sql:
         raise HTTPException(status_code=400, detail="No se pudo generar SQL; intenta ser más específico.")
 
-    # 2) Validación de políticas
-    ok, reason = is_safe_sql(sql)
+    # 2) Validación de políticas (un solo parseo, compartido por las etapas siguientes)
+    ast = parse_sql(sql)
+    ok, reason = is_safe_sql(sql, ast)
     if not ok:
         raise HTTPException(status_code=400, detail=f"Bloqueado: {reason}")
 
     # 2.1) Fix automático: id/geom + SRIDs + hectáreas (si corresponde)
-    sql_fixed, fixes = fix_sql(sql, in_.question or "")
+    sql_fixed, fixes = fix_sql(sql, in_.question or "", ast)
     if fixes:
         sql = sql_fixed
+        ast = parse_sql(sql)
 
     # 3) EXPLAIN-gate
-    plan = explain_summary(sql)
+    plan = await explain_summary(sql)
     if isinstance(plan, dict) and "error" in plan:
         return {
             "question": in_.question,
@@ -85,15 +93,16 @@ def chat(in_: ChatIn):
             "error": f"Plan bloqueado por coste/tamaño: {why}",
         }
 
-    # 4) Ejecutar (solo lectura)
-    rows = run_query_secure(sql) if in_.execute else []
-
-    # 5) Explicación breve en español (PostgreSQL/PostGIS)
+    # 4) Ejecutar (solo lectura) y 5) explicación breve en español (PostgreSQL/PostGIS)
+    #    en paralelo: la explicación sólo depende del SQL, no de las filas
     explanation_prompt = (
         "Explica en español, de forma breve y usando terminología de PostgreSQL/PostGIS, "
         f"qué hace esta consulta SQL:\n{sql}"
     )
-    explanation = infer_chat(explanation_prompt)
+    rows, explanation = await asyncio.gather(
+        run_query_secure(sql, ast=ast) if in_.execute else _no_rows(),
+        asyncio.to_thread(infer_chat, explanation_prompt),
+    )
 
     return {
         "question": in_.question,
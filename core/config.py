@@ -1,6 +1,15 @@
 # core/config.py
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pathlib import Path
+from functools import cached_property, lru_cache
+from typing import Optional
+
+# .env junto al repo (histórico de db/engine.py) y .env del directorio de trabajo;
+# el último gana si ambos definen la misma variable
+ENV_FILES = (Path(__file__).resolve().parents[2] / ".env", ".env")
+
+# Esquemas que el asistente puede ver (catálogo, search_path y prompts)
+ALLOWED_SCHEMAS = ["public", "datos_crudos", "datos_maestros", "medio_fisico", "specimen"]
 
 class Settings(BaseSettings):
     # Directorio base donde guardas los modelos
@@ -10,16 +19,45 @@ class Settings(BaseSettings):
     # Usa exactamente el nombre/carpeta que ya tienes
     MODEL_SQL_PATH: str = "sqlcoder-7b-2/sqlcoder-7b-q5_k_m.gguf"
 
+    # EAGER_LOAD_LLM=1 → cargar el modelo SQL en segundo plano al importar el cliente,
+    # en vez de hacerlo en la primera petición
+    EAGER_LOAD_LLM: bool = False
+
     # Ollama (Llama3) para explicaciones/chat
     OLLAMA_HOST: str = "http://127.0.0.1:11434"
     OLLAMA_CHAT_MODEL: str = "llama3"
 
+    # PostgreSQL/PostGIS (usuario de solo lectura del asistente)
+    DB_USER_LLM: Optional[str] = None
+    DB_PASSWORD_LLM: str = ""
+    DB_HOST_LLM: str = "localhost"
+    DB_PORT_LLM: str = "5432"
+    DB_NAME_LLM: Optional[str] = None
+
+    # PGBOUNCER=1 → conectar vía PgBouncer (pool_mode=transaction) en vez de directo
+    PGBOUNCER: bool = False
+    PGBOUNCER_HOST: Optional[str] = None
+    PGBOUNCER_PORT: str = "6432"
+
+    # Snapshot del catálogo escrito por scripts/warm_cache.py antes de lanzar los
+    # workers (p. ej. /dev/shm/schema_cache.pkl). Vacío (por defecto) = cada worker
+    # consulta la BD. Snapshots más viejos que SCHEMA_CACHE_MAX_AGE (s) se ignoran.
+    SCHEMA_CACHE_FILE: str = ""
+    SCHEMA_CACHE_MAX_AGE: int = 600
+
     # Pydantic settings
-    model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
+    model_config = SettingsConfigDict(
+        env_file=ENV_FILES, env_file_encoding="utf-8", extra="ignore"
+    )
 
-    # Ruta absoluta/normalizada al archivo GGUF de SQLCoder
-    @property
+    # Ruta absoluta/normalizada al archivo GGUF de SQLCoder (se resuelve una sola vez)
+    @cached_property
     def SQL_MODEL_FILE(self) -> str:
         return str((Path(self.MODELS_DIR) / self.MODEL_SQL_PATH).resolve())
 
-settings = Settings()
+@lru_cache
+def get_settings() -> Settings:
+    """Instancia única de Settings (el .env se parsea una sola vez)."""
+    return Settings()
+
+settings = get_settings()
@@ -1,45 +1,117 @@
-from sqlalchemy import create_engine, text
+import re
+from sqlglot import exp
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
 from urllib.parse import quote_plus
-from dotenv import dotenv_values
-from typing import List, Dict, Any
-from pathlib import Path
+from typing import List, Any, Mapping, Optional
+from core.config import settings
+from safeguards.sql_parser import parse_sql
 
-# Cargar .env desde ruta relativa al archivo
-BASE_DIR = Path(__file__).resolve().parent
-config = dotenv_values(BASE_DIR.parent.parent / ".env")
+user = settings.DB_USER_LLM
+pwd  = quote_plus(settings.DB_PASSWORD_LLM)  # URL-encode
+host = settings.DB_HOST_LLM
+port = settings.DB_PORT_LLM
+db   = settings.DB_NAME_LLM
 
-user = config.get("DB_USER_LLM")
-pwd  = quote_plus(config.get("DB_PASSWORD_LLM") or "")  # URL-encode
-host = config.get("DB_HOST_LLM", "localhost")
-db   = config.get("DB_NAME_LLM")
+# PGBOUNCER=1 → conectar vía PgBouncer (pool_mode=transaction) en vez de directo
+PGBOUNCER = settings.PGBOUNCER
+if PGBOUNCER:
+    host = settings.PGBOUNCER_HOST or host
+    port = settings.PGBOUNCER_PORT
 
-DSN = f"postgresql+psycopg://{user}:{pwd}@{host}/{db}"
+DSN = f"postgresql+psycopg://{user}:{pwd}@{host}:{port}/{db}"
 
-# Crea el engine con psycopg3
-engine = create_engine(DSN, pool_pre_ping=True)
+# Parámetros de sesión seguros (timeouts y search_path). Ajusta los esquemas a tu realidad:
+SESSION_SETTINGS = (
+    ("statement_timeout", "15000"),
+    ("idle_in_transaction_session_timeout", "10000"),
+    ("search_path", "datos_crudos,datos_maestros,medio_fisico,specimen,public"),
+)
 
-def run_query_secure(sql: str, limit_default: int = 500) -> List[Dict[str, Any]]:
+# Directo a Postgres: vía libpq "options", se aplican al abrir la conexión física,
+# sin round-trips extra por consulta.
+SESSION_OPTIONS = " ".join(f"-c {name}={value}" for name, value in SESSION_SETTINGS)
+
+# PgBouncer no acepta "options" en el arranque y en modo transacción no conserva
+# prepared statements ni parámetros de sesión: ahí se fijan por transacción con
+# set_config(..., is_local => true), equivalente a SET LOCAL, en una sola sentencia.
+SESSION_SET_LOCAL_SQL = "SELECT " + ", ".join(
+    f"set_config('{name}', '{value}', true)" for name, value in SESSION_SETTINGS
+)
+
+connect_args = {"prepare_threshold": None} if PGBOUNCER else {"options": SESSION_OPTIONS}
+
+async def apply_session_limits(conn: AsyncConnection) -> None:
+    """
+    Con PgBouncer, aplica SESSION_SETTINGS a la transacción en curso (la conexión física
+    puede ser otra en cada transacción). Directo a Postgres ya vienen en la conexión.
+    """
+    if PGBOUNCER:
+        await conn.exec_driver_sql(SESSION_SET_LOCAL_SQL)
+
+# Crea el engine asíncrono con psycopg3 (sin saltos al threadpool por consulta)
+engine = create_async_engine(
+    DSN,
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    connect_args=connect_args,
+)
+
+# Filas por lote al leer resultados con cursor del lado servidor
+STREAM_BATCH = 200
+
+_LIMIT_RE = re.compile(r"\blimit\b", re.IGNORECASE)
+
+def _has_limit(sql: str, ast: Optional[exp.Expression] = None) -> bool:
+    """
+    True si la sentencia principal ya limita filas (LIMIT/FETCH) según el AST de sqlglot.
+    Identificadores como `limit_date` o un LIMIT dentro de una subconsulta no cuentan.
+    """
+    expr = ast if ast is not None else parse_sql(sql)
+    if expr is None:
+        return _LIMIT_RE.search(sql) is not None
+    if not isinstance(expr, exp.Query):
+        # EXPLAIN u otros comandos: no se les agrega LIMIT
+        return True
+    return expr.args.get("limit") is not None
+
+async def run_query_secure(
+    sql: str, limit_default: int = 500, ast: Optional[exp.Expression] = None
+) -> List[Mapping[str, Any]]:
     """
     Ejecuta SELECT/WITH/EXPLAIN con timeouts y search_path controlado.
-    Fuerza LIMIT si no viene especificado.
+    Fuerza LIMIT si no viene especificado (usa `ast` si ya se parseó el SQL).
     """
-    # Forzar LIMIT si no aparece en la sentencia
-    sql_limited = sql if "limit" in sql.lower() else f"{sql.rstrip(';')} LIMIT {limit_default};"
-    with engine.begin() as conn:
-        # Timeouts y search_path seguros por sesión
-        conn.exec_driver_sql("SET statement_timeout TO '15s';")
-        conn.exec_driver_sql("SET idle_in_transaction_session_timeout TO '10s';")
-        # Ajusta los esquemas a tu realidad:
-        conn.exec_driver_sql(
-            "SET search_path TO datos_crudos, datos_maestros, medio_fisico, specimen, public;"
-        )
-        result = conn.execute(text(sql_limited))
-        rows = [dict(row) for row in result.mappings()]
-    return rows
-
-def ping_version() -> str:
+    expr = ast if ast is not None else parse_sql(sql)
+    # Forzar LIMIT si no aparece en la sentencia (en línea nueva: un `--` final no lo comenta)
+    sql_limited = sql if _has_limit(sql, expr) else f"{sql.rstrip().rstrip(';')}\nLIMIT {limit_default};"
+    rows: List[Mapping[str, Any]] = []
+    async with engine.begin() as conn:
+        await apply_session_limits(conn)
+        if not isinstance(expr, exp.Query):
+            # DECLARE ... CURSOR sólo acepta SELECT/VALUES: EXPLAIN (o SQL que sqlglot no
+            # entiende) va por ejecución normal
+            result = await conn.execute(text(sql_limited))
+            return list(result.mappings().fetchmany(limit_default))
+        # Cursor del lado servidor: filas en lotes de STREAM_BATCH, se corta al llegar al límite
+        async with conn.stream(
+            text(sql_limited), execution_options={"yield_per": STREAM_BATCH}
+        ) as result:
+            async for chunk in result.mappings().partitions():
+                # se guardan los RowMapping tal cual: orjson no los serializa, la copia a
+                # dict la hace jsonable_encoder de FastAPI al armar la respuesta
+                rows.extend(chunk)
+                if len(rows) >= limit_default:
+                    break
+    return rows[:limit_default]
+
+async def ping_version() -> str:
     """Devuelve la versión de PostgreSQL para verificar conectividad básica."""
-    with engine.begin() as conn:
-        conn.exec_driver_sql("SET statement_timeout TO '5s';")
-        v = conn.execute(text("SELECT version() AS ver")).scalar()
+    async with engine.begin() as conn:
+        # SET LOCAL: el timeout corto no se filtra a la conexión del pool
+        await conn.exec_driver_sql("SET LOCAL statement_timeout TO '5s';")
+        v = (await conn.execute(text("SELECT version() AS ver"))).scalar()
     return str(v)
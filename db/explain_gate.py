@@ -1,15 +1,39 @@
 # db/explain_gate.py
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Tuple
 from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
-from db.engine import engine
+from db.engine import apply_session_limits, engine
+from db.schema_cache import on_reload
+
+# Caché LRU+TTL de planes: el plan de un mismo SQL casi no cambia en segundos
+PLAN_CACHE_SIZE = 512
+PLAN_CACHE_TTL = 60.0  # segundos
+
+_plan_cache: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+on_reload(_plan_cache.clear)
+
+def _plan_key(sql: str) -> str:
+    """Hash del SQL normalizado (espacios colapsados, sin ';' final)."""
+    normalized = " ".join(sql.split()).rstrip(";")
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+async def explain_summary(sql: str) -> dict:
+    key = _plan_key(sql)
+    hit = _plan_cache.get(key)
+    if hit and time.monotonic() - hit[0] < PLAN_CACHE_TTL:
+        _plan_cache.move_to_end(key)
+        return dict(hit[1])
 
-def explain_summary(sql: str) -> dict:
     try:
-        with engine.begin() as conn:
-            conn.exec_driver_sql("SET statement_timeout TO '5s';")
-            plan_json = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+        async with engine.begin() as conn:
+            await apply_session_limits(conn)
+            await conn.exec_driver_sql("SET LOCAL statement_timeout TO '5s';")
+            plan_json = (await conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"))).scalar()
         plan = plan_json[0].get("Plan", {}) if isinstance(plan_json, list) else {}
-        return {
+        summary = {
             "node": plan.get("Node Type"),
             "startup_cost": plan.get("Startup Cost"),
             "total_cost": plan.get("Total Cost"),
@@ -17,8 +41,15 @@ def explain_summary(sql: str) -> dict:
             "plan_width": plan.get("Plan Width"),
         }
     except SQLAlchemyError as e:
+        # los errores no se cachean (pueden ser transitorios)
         return {"error": str(e.__cause__ or e)}
 
+    _plan_cache[key] = (time.monotonic(), summary)
+    _plan_cache.move_to_end(key)
+    if len(_plan_cache) > PLAN_CACHE_SIZE:
+        _plan_cache.popitem(last=False)
+    return dict(summary)
+
 def too_expensive(plan: dict) -> tuple[bool, str]:
     if not plan or "total_cost" not in plan:
         return False, ""
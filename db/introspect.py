@@ -1,79 +1,76 @@
 # db/introspect.py
 from __future__ import annotations
 import re
+from functools import lru_cache
 from typing import List, Tuple, Dict, Any, Optional
 
 # Dependencias del caché/catálogo
 from db.schema_cache import (
     get_table,            # -> retorna metadata de la tabla
-    suggest_id_column,    # -> sugiere PK real
-    preferred_geom,       # -> sugiere columna geom (geometria/geometry/geom/etc.)
+    get_ctx_line,         # -> línea de contexto precalculada al cargar el catálogo
+    find_table_mentions,  # -> nombres de tabla sueltos (Aho-Corasick)
+    format_ctx_line,      # -> línea de contexto con overrides de pk/geom/srid
+    on_reload,            # -> invalida cachés cuando se recarga el catálogo
 )
 
 # ---- Detectar referencias a tablas en texto ---------------------------------
 
-# 1) Forma "schema.tabla"
+# Motor RE2 (tiempo lineal, sin backtracking) si está disponible; si no, `re`.
+# Los flags van inline en el patrón para que ambos motores lo compilen igual.
+# Ojo: en RE2 `\b` y `\w` son sólo ASCII, mientras que en `re` letras como ñ/á son
+# caracteres de palabra ("año.tabla" daría ('o', 'tabla') con RE2). Por eso:
+try:
+    import re2 as _ref_re
+    # límite de palabra explícito en Unicode (RE2 no tiene lookbehind: se consume 1 carácter)
+    _WORD_START = r"(?:^|[^\p{L}\p{N}_])"
+except ImportError:
+    _ref_re = re
+    _WORD_START = r"\b"
+
+# 1) Forma "schema.tabla": siempre con `re` (sin `.*?`, no hay backtracking que evitar
+#    y conserva los límites de palabra Unicode)
 DOT_REF_RE = re.compile(r"\b([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)\b")
 
 # 2) Frases tipo: "del esquema datos_maestros ... tabla dpa_region_subdere"
-PHRASE_REF_RE = re.compile(
-    r"(?:\besquema\b|\bschema\b)\s+([a-zA-Z0-9_]+).*?(?:\btabla\b|\btable\b)\s+([a-zA-Z0-9_]+)",
-    re.IGNORECASE | re.DOTALL,
+#    (el `.*?` con DOTALL es cuadrático con backtracking en textos largos: RE2 si hay)
+PHRASE_REF_RE = _ref_re.compile(
+    rf"(?is){_WORD_START}(?:esquema|schema)\s+([a-zA-Z0-9_]+).*?{_WORD_START}(?:tabla|table)\s+([a-zA-Z0-9_]+)"
 )
 
-def find_table_refs(text: str) -> List[Tuple[str, str]]:
+def find_table_refs(text: str, bare_names: bool = True) -> List[Tuple[str, str]]:
     """
     Extrae pares (schema, table) tanto en forma 'schema.tabla' como en frases:
-    '... del esquema X ... tabla Y ...'.
+    '... del esquema X ... tabla Y ...', y nombres de tabla del catálogo mencionados
+    sin esquema ('... las comunas ...').
+
+    Con bare_names=False se omiten los nombres sueltos: en SQL un nombre sin esquema
+    puede ser una CTE o un alias, no la tabla del catálogo.
     """
-    refs: List[Tuple[str, str]] = []
     if not text:
-        return refs
+        return []
+    return list(_find_table_refs_cached(text, bare_names))
+
+@lru_cache(maxsize=1024)
+def _find_table_refs_cached(text: str, bare_names: bool) -> Tuple[Tuple[str, str], ...]:
+    refs: List[Tuple[str, str]] = []
 
     # a) 'schema.table'
-    for s, t in DOT_REF_RE.findall(text):
-        refs.append((s, t))
+    refs.extend(DOT_REF_RE.findall(text))
 
     # b) 'esquema X ... tabla Y'
-    for s, t in PHRASE_REF_RE.findall(text):
-        refs.append((s, t))
+    refs.extend(PHRASE_REF_RE.findall(text))
+
+    # c) nombre de tabla suelto, sólo si esa tabla no vino ya calificada
+    if bare_names:
+        named = {t for _, t in refs}
+        refs.extend(st for st in find_table_mentions(text) if st[1] not in named)
 
     # quitar duplicados preservando orden
-    seen = set()
-    uniq: List[Tuple[str, str]] = []
-    for st in refs:
-        if st not in seen:
-            uniq.append(st)
-            seen.add(st)
-    return uniq
+    return tuple(dict.fromkeys(refs))
 
 
 # ---- Construir contexto de esquema para el prompt ---------------------------
 
-def _columns_preview(ti: Any) -> str:
-    """
-    Intenta renderizar una lista corta de columnas desde la metadata de la tabla.
-    Soporta dict/list/tuplas/objetos con atributo 'name'.
-    """
-    cols = getattr(ti, "columns", None)
-    names: List[str] = []
-    if isinstance(cols, dict):
-        names = list(cols.keys())
-    elif isinstance(cols, (list, tuple)):
-        for c in cols:
-            if isinstance(c, str):
-                names.append(c)
-            elif hasattr(c, "name"):
-                names.append(str(getattr(c, "name")))
-            elif isinstance(c, (list, tuple)) and c:
-                names.append(str(c[0]))
-            else:
-                names.append(str(c))
-    # corta para no hacer prompts gigantes
-    if not names:
-        return ""
-    return ", ".join(names[:30])
-
 def build_schema_ctx(question_or_sql: str, extra_metadata: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
     """
     Construye líneas compactas por cada (schema.table) detectado:
@@ -82,8 +79,22 @@ def build_schema_ctx(question_or_sql: str, extra_metadata: Optional[Dict[str, Di
     - Usa find_table_refs() para detectar tablas en la pregunta/SQL.
     - Obtiene PK/geom/SRID reales del catálogo (db.schema_cache).
     - Permite sobreescrituras vía extra_metadata (opcional).
+
+    Sin extra_metadata el resultado se memoiza por texto (se invalida al recargar el catálogo).
     """
-    refs = find_table_refs(question_or_sql or "")
+    if extra_metadata:
+        return _build_schema_ctx(question_or_sql or "", extra_metadata)
+    return _build_schema_ctx_cached(question_or_sql or "")
+
+@lru_cache(maxsize=1024)
+def _build_schema_ctx_cached(question_or_sql: str) -> str:
+    return _build_schema_ctx(question_or_sql, None)
+
+on_reload(_find_table_refs_cached.cache_clear)
+on_reload(_build_schema_ctx_cached.cache_clear)
+
+def _build_schema_ctx(question_or_sql: str, extra_metadata: Optional[Dict[str, Dict[str, Any]]]) -> str:
+    refs = find_table_refs(question_or_sql)
     if not refs:
         return ""
 
@@ -91,35 +102,24 @@ def build_schema_ctx(question_or_sql: str, extra_metadata: Optional[Dict[str, Di
     extra_metadata = extra_metadata or {}
 
     for schema, table in refs:
-        ti = get_table(schema, table)
+        key = f"{schema}.{table}"
+        if key not in extra_metadata:
+            # Camino normal: línea ya formateada en load_schema_cache
+            lines.append(get_ctx_line(key) or f"{key} | pk=unk | geom=unk | srid=unk")
+            continue
+
+        ti = get_table(key)
         if not ti:
             # Si no encontramos metadata, al menos listamos el nombre
-            lines.append(f"{schema}.{table} | pk=unk | geom=unk | srid=unk")
+            lines.append(f"{key} | pk=unk | geom=unk | srid=unk")
             continue
 
-        # columnas (si están disponibles)
-        cols_preview = _columns_preview(ti)
-        cols_txt = f"(cols: {cols_preview}) " if cols_preview else ""
-
-        # hints base desde catálogo
-        pk_hint = suggest_id_column(ti)
-        geom_hint = preferred_geom(ti)
-        srid_val = getattr(getattr(ti, "geom", None), "srid", None)
-
-        # overrides desde extra_metadata si vienen
-        key = f"{schema}.{table}"
-        if key in extra_metadata:
-            md = extra_metadata[key]
-            pk_hint = md.get("pk", pk_hint)
-            geom_hint = md.get("geom_col", md.get("geom", geom_hint))
-            srid_val = md.get("srid", srid_val)
-
-        srid_txt = str(srid_val) if srid_val is not None else "unk"
-        pk_txt = pk_hint or "unk"
-        geom_txt = geom_hint or "unk"
-
-        line = f"{schema}.{table} {cols_txt}| pk={pk_txt} | geom={geom_txt} | srid={srid_txt}"
-        lines.append(line)
+        # hints desde catálogo, con overrides desde extra_metadata
+        md = extra_metadata[key]
+        overrides = {k: md[k] for k in ("pk", "srid") if k in md}
+        if "geom_col" in md or "geom" in md:
+            overrides["geom"] = md.get("geom_col", md.get("geom"))
+        lines.append(format_ctx_line(ti, **overrides))
 
     # limitar tamaño total del contexto
     ctx = "\n".join(lines)
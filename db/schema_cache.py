@@ -1,162 +1,355 @@
 # db/schema_cache.py
 from __future__ import annotations
+import logging
+import os
+import pickle
+import sys
+import time
+import unicodedata
+from collections import defaultdict
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
-from sqlalchemy import text
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import ahocorasick
 from db.engine import engine
 
 PREFERRED_GEOM_ORDER = ("geometria", "geometry", "geom", "the_geom")
+# Rango por nombre (O(1)) en vez de PREFERRED_GEOM_ORDER.index(...)
+_GEOM_RANK: Dict[str, int] = {name: i for i, name in enumerate(PREFERRED_GEOM_ORDER)}
 
-@dataclass
+# Metadata inmutable: slots (menos memoria, acceso más rápido) y strings internados
+@dataclass(slots=True, frozen=True)
 class ColumnInfo:
     name: str
     data_type: str
     is_nullable: bool
     is_pk: bool = False
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class GeometryInfo:
     column: str
     srid: Optional[int]
     gtype: Optional[str]  # POINT/POLYGON/…
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class IndexInfo:
     name: str
     method: str  # gist/brin/btree
-    columns: List[str]
+    columns: Tuple[str, ...]
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TableInfo:
     schema: str
     table: str
-    columns: List[ColumnInfo]
-    pk_cols: List[str]
+    columns: Tuple[ColumnInfo, ...]
+    pk_cols: Tuple[str, ...]
     geom: Optional[GeometryInfo]
-    indexes: List[IndexInfo]
-    fks: List[Tuple[List[str], str, List[str]]]  # (local_cols, ref_table, ref_cols)
+    indexes: Tuple[IndexInfo, ...]
+    fks: Tuple[Tuple[Tuple[str, ...], str, Tuple[str, ...]], ...]  # (local_cols, ref_table, ref_cols)
 
 _cache: Dict[Tuple[str, str], TableInfo] = {}
+# Línea de contexto para el prompt, precalculada al cargar el catálogo
+_ctx_lines: Dict[str, str] = {}  # clave "schema.table"
+# Índice por "schema.table" (y su variante en minúsculas) para una sola búsqueda
+_cache_by_fqn: Dict[str, TableInfo] = {}
+# Índice exacto nombre de tabla -> (schema, table), para identificadores SQL sin schema
+_tables_by_name: Dict[str, Tuple[Tuple[str, str], ...]] = {}
+# Aho-Corasick sobre nombres de tabla: detecta menciones "sueltas" en una pasada
+_name_automaton: Optional[ahocorasick.Automaton] = None
+# Nombres más cortos generan demasiados falsos positivos en texto libre
+MIN_TABLE_NAME_LEN = 3
 _loaded = False
 
-def _fetch_rows(sql: str, **params):
-    with engine.begin() as conn:
-        return list(conn.execute(text(sql), params))
-
-def _load_columns(schema: str, table: str) -> List[ColumnInfo]:
-    rows = _fetch_rows("""
-        SELECT column_name, data_type, is_nullable
-        FROM information_schema.columns
-        WHERE table_schema=:s AND table_name=:t
-        ORDER BY ordinal_position
-    """, s=schema, t=table)
-    return [ColumnInfo(r[0], r[1], r[2] == "YES") for r in rows]
-
-def _load_pk(schema: str, table: str) -> List[str]:
-    rows = _fetch_rows("""
-        SELECT a.attname
-        FROM pg_index i
-        JOIN pg_class c ON c.oid=i.indrelid
-        JOIN pg_namespace n ON n.oid=c.relnamespace
-        JOIN pg_attribute a ON a.attrelid=c.oid AND a.attnum = ANY(i.indkey)
-        WHERE n.nspname=:s AND c.relname=:t AND i.indisprimary
-        ORDER BY a.attnum
-    """, s=schema, t=table)
-    return [r[0] for r in rows]
-
-def _load_indexes(schema: str, table: str) -> List[IndexInfo]:
-    rows = _fetch_rows("""
-        SELECT i.relname AS index_name,
-               am.amname  AS method,
-               array_agg(a.attname ORDER BY a.attnum) AS cols
-        FROM pg_index idx
-        JOIN pg_class t ON t.oid=idx.indrelid
-        JOIN pg_namespace n ON n.oid=t.relnamespace
-        JOIN pg_class i ON i.oid=idx.indexrelid
-        JOIN pg_am am ON am.oid=i.relam
-        JOIN pg_attribute a ON a.attrelid=t.oid AND a.attnum = ANY(idx.indkey)
-        WHERE n.nspname=:s AND t.relname=:t
-        GROUP BY i.relname, am.amname
-    """, s=schema, t=table)
-    return [IndexInfo(r[0], r[1], list(r[2])) for r in rows]
-
-def _load_fks(schema: str, table: str) -> List[Tuple[List[str], str, List[str]]]:
-    rows = _fetch_rows("""
-        SELECT
-          array_agg(la.attname ORDER BY la.attnum) AS local_cols,
-          rn.nspname || '.' || rt.relname AS ref_table,
-          array_agg(ra.attname ORDER BY ra.attnum) AS ref_cols
-        FROM pg_constraint c
-        JOIN pg_class lt ON lt.oid = c.conrelid
-        JOIN pg_namespace ln ON ln.oid = lt.relnamespace
-        JOIN pg_class rt ON rt.oid = c.confrelid
-        JOIN pg_namespace rn ON rn.oid = rt.relnamespace
-        JOIN unnest(c.conkey) WITH ORDINALITY AS l(attnum, ord) ON TRUE
-        JOIN unnest(c.confkey) WITH ORDINALITY AS r(attnum, ord) ON r.ord = l.ord
-        JOIN pg_attribute la ON la.attrelid = lt.oid AND la.attnum = l.attnum
-        JOIN pg_attribute ra ON ra.attrelid = rt.oid AND ra.attnum = r.attnum
-        WHERE c.contype='f' AND ln.nspname=:s AND lt.relname=:t
-        GROUP BY rn.nspname, rt.relname
-    """, s=schema, t=table)
-    return [(list(r[0]), r[1], list(r[2])) for r in rows]
-
-def _load_geometry(schema: str, table: str) -> Optional[GeometryInfo]:
-    # geometry_columns (siempre que esté poblada)
-    rows = _fetch_rows("""
-        SELECT f_geometry_column, srid, type
-        FROM public.geometry_columns
-        WHERE f_table_schema=:s AND f_table_name=:t
-    """, s=schema, t=table)
-    if rows:
-        best = sorted(
-            rows,
-            key=lambda r: PREFERRED_GEOM_ORDER.index(r[0])
-            if r[0] in PREFERRED_GEOM_ORDER else len(PREFERRED_GEOM_ORDER)
-        )[0]
-        return GeometryInfo(best[0], best[1], best[2])
+# Callbacks invocados tras recargar el catálogo (limpian cachés derivados)
+_reload_hooks: List[Callable[[], None]] = []
+
+def on_reload(fn: Callable[[], None]) -> Callable[[], None]:
+    """Registra fn para que se ejecute cada vez que se recarga el catálogo."""
+    _reload_hooks.append(fn)
+    return fn
+
+async def _fetch_pipelined(queries: List[Tuple[str, Dict[str, Any]]]) -> List[List[tuple]]:
+    """
+    Ejecuta varias consultas en modo pipeline de psycopg sobre una sola conexión:
+    se envían todas sin esperar respuesta y se drenan al final (1 RTT en total).
+    """
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        aconn = raw.driver_connection
+        async with aconn.pipeline():
+            cursors = [await aconn.execute(sql, params) for sql, params in queries]
+        return [await cur.fetchall() for cur in cursors]
+
+# Consultas de catálogo por esquema: cada fila parte con (schema, table, ...)
+# (placeholders de psycopg: van directo al driver)
+_TABLES_SQL = """
+    SELECT table_schema, table_name
+    FROM information_schema.tables
+    WHERE table_type='BASE TABLE' AND table_schema = ANY(%(schemas)s)
+"""
+
+_COLUMNS_SQL = """
+    SELECT table_schema, table_name, column_name, data_type, is_nullable
+    FROM information_schema.columns
+    WHERE table_schema = ANY(%(schemas)s)
+    ORDER BY table_schema, table_name, ordinal_position
+"""
+
+_PK_SQL = """
+    SELECT n.nspname, c.relname, a.attname
+    FROM pg_index i
+    JOIN pg_class c ON c.oid=i.indrelid
+    JOIN pg_namespace n ON n.oid=c.relnamespace
+    JOIN pg_attribute a ON a.attrelid=c.oid AND a.attnum = ANY(i.indkey)
+    WHERE n.nspname = ANY(%(schemas)s) AND i.indisprimary
+    ORDER BY n.nspname, c.relname, a.attnum
+"""
+
+_INDEXES_SQL = """
+    SELECT n.nspname, t.relname,
+           i.relname AS index_name,
+           am.amname  AS method,
+           array_agg(a.attname ORDER BY a.attnum) AS cols
+    FROM pg_index idx
+    JOIN pg_class t ON t.oid=idx.indrelid
+    JOIN pg_namespace n ON n.oid=t.relnamespace
+    JOIN pg_class i ON i.oid=idx.indexrelid
+    JOIN pg_am am ON am.oid=i.relam
+    JOIN pg_attribute a ON a.attrelid=t.oid AND a.attnum = ANY(idx.indkey)
+    WHERE n.nspname = ANY(%(schemas)s)
+    GROUP BY n.nspname, t.relname, i.relname, am.amname
+"""
+
+_FKS_SQL = """
+    SELECT
+      ln.nspname, lt.relname,
+      array_agg(la.attname ORDER BY la.attnum) AS local_cols,
+      rn.nspname || '.' || rt.relname AS ref_table,
+      array_agg(ra.attname ORDER BY ra.attnum) AS ref_cols
+    FROM pg_constraint c
+    JOIN pg_class lt ON lt.oid = c.conrelid
+    JOIN pg_namespace ln ON ln.oid = lt.relnamespace
+    JOIN pg_class rt ON rt.oid = c.confrelid
+    JOIN pg_namespace rn ON rn.oid = rt.relnamespace
+    JOIN unnest(c.conkey) WITH ORDINALITY AS l(attnum, ord) ON TRUE
+    JOIN unnest(c.confkey) WITH ORDINALITY AS r(attnum, ord) ON r.ord = l.ord
+    JOIN pg_attribute la ON la.attrelid = lt.oid AND la.attnum = l.attnum
+    JOIN pg_attribute ra ON ra.attrelid = rt.oid AND ra.attnum = r.attnum
+    WHERE c.contype='f' AND ln.nspname = ANY(%(schemas)s)
+    GROUP BY ln.nspname, lt.relname, rn.nspname, rt.relname
+"""
+
+# geometry_columns (siempre que esté poblada)
+_GEOMETRY_SQL = """
+    SELECT f_table_schema, f_table_name, f_geometry_column, srid, type
+    FROM public.geometry_columns
+    WHERE f_table_schema = ANY(%(schemas)s)
+"""
+
+_CATALOG_QUERIES = (_TABLES_SQL, _COLUMNS_SQL, _PK_SQL, _INDEXES_SQL, _FKS_SQL, _GEOMETRY_SQL)
+
+def _group_by_table(rows: List[tuple]) -> Dict[Tuple[str, str], List[tuple]]:
+    """Agrupa filas (schema, table, *payload) por (schema, table), preservando orden."""
+    grouped: Dict[Tuple[str, str], List[tuple]] = defaultdict(list)
+    for r in rows:
+        grouped[(r[0], r[1])].append(tuple(r[2:]))
+    return grouped
+
+def _pick_geometry(geom_rows: List[tuple], cols: Tuple[ColumnInfo, ...]) -> Optional[GeometryInfo]:
+    if geom_rows:
+        best = min(geom_rows, key=lambda r: _GEOM_RANK.get(r[0], len(PREFERRED_GEOM_ORDER)))
+        return GeometryInfo(sys.intern(best[0]), best[1], best[2])
 
     # Fallback por nombre conocido si geometry_columns no está poblada
-    cols = _load_columns(schema, table)
-    candidates = [c.name for c in cols if c.name.lower() in PREFERRED_GEOM_ORDER]
+    candidates = [c.name for c in cols if c.name.lower() in _GEOM_RANK]
     if candidates:
-        c0 = sorted(candidates, key=lambda n: PREFERRED_GEOM_ORDER.index(n))[0]
+        c0 = min(candidates, key=lambda n: _GEOM_RANK[n.lower()])
         return GeometryInfo(c0, None, None)
     return None
 
-def load_schema_cache(allowed_schemas: List[str]) -> None:
-    global _cache, _loaded
-    _cache.clear()
-    tables = _fetch_rows("""
-        SELECT table_schema, table_name
-        FROM information_schema.tables
-        WHERE table_type='BASE TABLE' AND table_schema = ANY(:schemas)
-    """, schemas=allowed_schemas)
+def _build_table_info(
+    s: str, t: str,
+    col_rows: List[tuple], pk_rows: List[tuple], idx_rows: List[tuple],
+    fk_rows: List[tuple], geom_rows: List[tuple],
+) -> TableInfo:
+    intern = sys.intern
+    pk_cols = tuple(intern(r[0]) for r in pk_rows)  # en orden de attnum
+    pk = frozenset(pk_cols)
+    cols = tuple(
+        ColumnInfo(intern(r[0]), intern(r[1]), r[2] == "YES", r[0] in pk)
+        for r in col_rows
+    )
+    return TableInfo(
+        schema=s, table=t, columns=cols, pk_cols=pk_cols,
+        geom=_pick_geometry(geom_rows, cols),
+        indexes=tuple(IndexInfo(intern(r[0]), intern(r[1]), tuple(map(intern, r[2]))) for r in idx_rows),
+        fks=tuple((tuple(map(intern, r[0])), intern(r[1]), tuple(map(intern, r[2]))) for r in fk_rows),
+    )
+
+async def load_schema_cache(allowed_schemas: List[str]) -> None:
+    params = {"schemas": list(allowed_schemas)}
+    tables, *per_table = await _fetch_pipelined([(q, params) for q in _CATALOG_QUERIES])
+    cols_by, pk_by, idx_by, fk_by, geom_by = (_group_by_table(rows) for rows in per_table)
+    cache: Dict[Tuple[str, str], TableInfo] = {}
     for s, t in tables:
-        cols = _load_columns(s, t)
-        pk = set(_load_pk(s, t))
-        for c in cols:
-            if c.name in pk:
-                c.is_pk = True
-        geom = _load_geometry(s, t)
-        idxs = _load_indexes(s, t)
-        fks = _load_fks(s, t)
-        _cache[(s, t)] = TableInfo(
-            schema=s, table=t, columns=cols, pk_cols=list(pk),
-            geom=geom, indexes=idxs, fks=fks
+        key = (s, t)
+        s, t = sys.intern(s), sys.intern(t)
+        cache[(s, t)] = _build_table_info(
+            s, t, cols_by.get(key, []), pk_by.get(key, []), idx_by.get(key, []),
+            fk_by.get(key, []), geom_by.get(key, []),
         )
+    _install_cache(cache)
+
+def _install_cache(cache: Dict[Tuple[str, str], TableInfo]) -> None:
+    """Publica el catálogo y reconstruye las vistas derivadas (líneas, índices)."""
+    global _loaded, _name_automaton
+    _cache.clear()
+    _ctx_lines.clear()
+    _cache_by_fqn.clear()
+    _tables_by_name.clear()
+    for ti in cache.values():
+        s, t = sys.intern(ti.schema), sys.intern(ti.table)
+        _cache[(s, t)] = ti
+        fqn = sys.intern(f"{s}.{t}")
+        line = format_ctx_line(ti)
+        _cache_by_fqn[fqn], _ctx_lines[fqn] = ti, line
+        # la variante en minúsculas no pisa un nombre exacto ya registrado
+        _cache_by_fqn.setdefault(fqn.lower(), ti)
+        _ctx_lines.setdefault(fqn.lower(), line)
+        _tables_by_name[t] = _tables_by_name.get(t, ()) + ((s, t),)
+    _name_automaton = _build_name_automaton(_cache.keys())
     _loaded = True
+    for hook in _reload_hooks:
+        hook()
 
-def get_table(schema: str, table: str) -> Optional[TableInfo]:
-    return _cache.get((schema, table))
+# ---- Snapshot en disco (warm-up previo al fork de los workers) ---------------
+
+def dump_schema_cache(path: str, allowed_schemas: List[str]) -> None:
+    """
+    Guarda el catálogo cargado en `path` (p. ej. /dev/shm). Escribe a un temporal y
+    renombra, para que ningún worker lea un archivo a medio escribir.
+    """
+    payload = {"schemas": tuple(allowed_schemas), "tables": _cache}
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(payload, f, protocol=5)
+    os.replace(tmp, path)
+
+def _valid_snapshot(payload: Any, allowed_schemas: List[str]) -> bool:
+    """Snapshot de dump_schema_cache para estos esquemas y con el layout actual de TableInfo."""
+    if not isinstance(payload, dict) or payload.get("schemas") != tuple(allowed_schemas):
+        return False
+    tables = payload.get("tables")
+    if not isinstance(tables, dict):
+        return False
+    # un TableInfo de otra versión de la clase puede llegar sin algún slot
+    return all(
+        isinstance(ti, TableInfo) and all(hasattr(ti, f) for f in TableInfo.__slots__)
+        for ti in tables.values()
+    )
+
+def load_schema_cache_file(path: str, allowed_schemas: List[str], max_age: Optional[float] = None) -> bool:
+    """
+    Carga el catálogo desde un snapshot de dump_schema_cache. Devuelve False si no existe,
+    no es del usuario actual, tiene más de `max_age` segundos, es de otros esquemas o no
+    se puede leer/instalar; el llamador debe entonces cargar desde la BD.
+    """
+    log = logging.getLogger(__name__)
+    try:
+        st = os.stat(path)
+        # pickle ejecuta código al cargar: sólo se aceptan archivos propios
+        if st.st_uid != os.getuid():
+            log.warning("Snapshot de catálogo %s ignorado: no pertenece al usuario actual", path)
+            return False
+        age = time.time() - st.st_mtime
+        if max_age is not None and age > max_age:
+            log.warning("Snapshot de catálogo %s ignorado: tiene %.0f s (máx. %.0f)", path, age, max_age)
+            return False
+        with open(path, "rb") as f:
+            payload = pickle.load(f)
+        if not _valid_snapshot(payload, allowed_schemas):
+            return False
+        _install_cache(payload["tables"])
+    except Exception as e:
+        # cualquier snapshot corrupto u obsoleto se ignora (la BD es la fuente de verdad)
+        if not isinstance(e, FileNotFoundError):
+            log.warning("Snapshot de catálogo %s inválido: %s", path, e)
+        return False
+    return True
+
+def _fqn_get(d: Dict[str, Any], schema_or_fqn: str, table: Optional[str]) -> Any:
+    fqn = schema_or_fqn if table is None else f"{schema_or_fqn}.{table}"
+    hit = d.get(fqn)
+    return hit if hit is not None else d.get(fqn.lower())
+
+def get_table(schema_or_fqn: str, table: Optional[str] = None) -> Optional[TableInfo]:
+    """
+    Busca por (schema, table) o por "schema.table". Si no hay coincidencia exacta,
+    prueba en minúsculas (Postgres pliega a minúsculas los identificadores sin comillas).
+    """
+    if table is not None:
+        ti = _cache.get((schema_or_fqn, table))
+        if ti is not None:
+            return ti
+    return _fqn_get(_cache_by_fqn, schema_or_fqn, table)
+
+def get_ctx_line(schema_or_fqn: str, table: Optional[str] = None) -> Optional[str]:
+    return _fqn_get(_ctx_lines, schema_or_fqn, table)
+
+def find_tables_by_name(name: str) -> Tuple[Tuple[str, str], ...]:
+    """
+    (schema, table) cuyo nombre es exactamente `name` (sin plegar tildes ni mayúsculas):
+    para identificadores de SQL. Para texto libre usar find_table_mentions.
+    """
+    return _tables_by_name.get(name, ())
+
+def _fold(text: str) -> str:
+    """Minúsculas y sin tildes (NFKD sin marcas combinantes)."""
+    nfkd = unicodedata.normalize("NFKD", text.lower())
+    return "".join(ch for ch in nfkd if not unicodedata.combining(ch))
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+def _build_name_automaton(keys) -> Optional[ahocorasick.Automaton]:
+    by_name: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+    for s, t in keys:
+        name = _fold(t)
+        if len(name) >= MIN_TABLE_NAME_LEN:
+            by_name[name].append((s, t))
+    if not by_name:
+        return None
+    automaton = ahocorasick.Automaton()
+    for name, refs in by_name.items():
+        automaton.add_word(name, (len(name), tuple(refs)))
+    automaton.make_automaton()
+    return automaton
+
+def find_table_mentions(text: str) -> List[Tuple[str, str]]:
+    """
+    Pares (schema, table) cuyo nombre de tabla aparece como palabra completa en el texto
+    (sin importar mayúsculas ni tildes). Un nombre presente en varios esquemas devuelve todos.
+    """
+    if _name_automaton is None or not text:
+        return []
+    folded = _fold(text)
+    hits: List[Tuple[str, str]] = []
+    for end, (length, refs) in _name_automaton.iter(folded):
+        start = end - length + 1
+        if start > 0 and _is_word_char(folded[start - 1]):
+            continue
+        if end + 1 < len(folded) and _is_word_char(folded[end + 1]):
+            continue
+        hits.extend(refs)
+    return hits
 
 def best_geom_column(ti: TableInfo) -> Optional[str]:
     if ti.geom:
         return ti.geom.column
-    names = [c.name for c in ti.columns]
-    for pref in PREFERRED_GEOM_ORDER:
-        if pref in names:
-            return pref
-    return None
+    return min(
+        (c.name for c in ti.columns if c.name in _GEOM_RANK),
+        key=_GEOM_RANK.__getitem__,
+        default=None,
+    )
 
 def to_ctx_line(ti: TableInfo) -> str:
     cols_txt = ", ".join(
@@ -182,3 +375,27 @@ def suggest_id_column(ti: TableInfo) -> Optional[str]:
 
 def preferred_geom(ti: TableInfo) -> Optional[str]:
     return best_geom_column(ti)
+
+# Marca "sin override" (None es un valor válido: se muestra como "unk")
+_FROM_CATALOG: Any = object()
+
+def format_ctx_line(
+    ti: TableInfo, pk: Any = _FROM_CATALOG, geom: Any = _FROM_CATALOG, srid: Any = _FROM_CATALOG
+) -> str:
+    """
+    <schema>.<table> (cols: col1, col2, ...) | pk=<...> | geom=<...> | srid=<...>
+    (formato de build_schema_ctx; máx. 30 columnas para no hacer prompts gigantes)
+    pk/geom/srid sobreescriben lo que se deduce del catálogo (extra_metadata).
+    """
+    names = [c.name for c in ti.columns[:30]]
+    cols_txt = f"(cols: {', '.join(names)}) " if names else ""
+    if pk is _FROM_CATALOG:
+        pk = suggest_id_column(ti)
+    if geom is _FROM_CATALOG:
+        geom = preferred_geom(ti)
+    if srid is _FROM_CATALOG:
+        srid = ti.geom.srid if ti.geom else None
+    pk_txt = pk or "unk"
+    geom_txt = geom or "unk"
+    srid_txt = str(srid) if srid is not None else "unk"
+    return f"{ti.schema}.{ti.table} {cols_txt}| pk={pk_txt} | geom={geom_txt} | srid={srid_txt}"
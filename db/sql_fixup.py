@@ -1,19 +1,20 @@
 # db/sql_fixup.py
 import re
+from functools import lru_cache
 from typing import Dict, List, Tuple, Optional, Set
+from sqlglot import exp
 from db.introspect import find_table_refs
-from db.schema_cache import get_table as cache_get_table, suggest_id_column, preferred_geom
+from db.schema_cache import (
+    get_table as cache_get_table, suggest_id_column, preferred_geom, find_tables_by_name,
+    on_reload,
+)
 
 # SRID proyectado para unidades métricas/hectáreas
 METRIC_SRID = 32719  # EPSG:32719 (UTM 19S)
 
-# Regex para capturar alias en FROM/JOIN
-ALIAS_FROM_RE = re.compile(
-    r"\bfrom\s+([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)\s+(?:as\s+)?([a-zA-Z_][a-zA-Z0-9_]*)",
-    re.IGNORECASE,
-)
-ALIAS_JOIN_RE = re.compile(
-    r"\bjoin\s+([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)\s+(?:as\s+)?([a-zA-Z_][a-zA-Z0-9_]*)",
+# Regex para capturar alias en FROM/JOIN (una sola pasada; el grupo 1 dice cuál)
+ALIAS_RE = re.compile(
+    r"\b(from|join)\s+([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)\s+(?:as\s+)?([a-zA-Z_][a-zA-Z0-9_]*)",
     re.IGNORECASE,
 )
 
@@ -26,48 +27,153 @@ TBL_COL_RE = re.compile(
     r"\b([a-zA-Z0-9_]+)\.([a-zA-Z_][a-zA-Z0-9_]*)\b"
 )
 
-def _collect_aliases(sql: str) -> Dict[str, Tuple[str, str]]:
-    alias_map: Dict[str, Tuple[str, str]] = {}
-    for m in ALIAS_FROM_RE.finditer(sql):
-        alias_map[m.group(3)] = (m.group(1), m.group(2))
-    for m in ALIAS_JOIN_RE.finditer(sql):
-        alias_map[m.group(3)] = (m.group(1), m.group(2))
-    return alias_map
+# [schema.]alias_o_tabla.(id|geom|geometry|geometria) en un solo patrón: el prefijo y
+# el tipo de columna se resuelven en un callback (una sola pasada de re.sub)
+COL_REF_RE = re.compile(
+    r"\b(?:([a-zA-Z0-9_]+)\.)?([a-zA-Z0-9_]+)\.(id|(?i:geom|geometry|geometria))\b"
+)
+
+# Funciones espaciales que se reescriben en los pasos 7 y 8 de fix_sql
+ST_PAIR_RE = re.compile(
+    r"\b(ST_DWithin|ST_Intersects)\s*\(\s*([^,]+)\s*,\s*([^,]+)\s*(,\s*[^)]+)?\)",
+    re.IGNORECASE,
+)
+ST_AREA_RE = re.compile(r"\bST_Area\s*\(\s*([^)]+)\s*\)", re.IGNORECASE)
+ST_TRANSFORM_RE = re.compile(r"ST_Transform\s*\(", re.IGNORECASE)
+
+# Nombres de CTE en el texto ("WITH [RECURSIVE] x [(cols)] AS (" o ", x AS ("), para
+# cuando no hay AST de consulta
+CTE_NAME_RE = re.compile(
+    r"(?:\bwith\s+(?:recursive\s+)?|,\s*)([a-zA-Z_][a-zA-Z0-9_]*)(?:\s*\([^)]*\))?"
+    r"\s+as\s*(?:(?:not\s+)?materialized\s*)?\(",
+    re.IGNORECASE,
+)
 
+def _collect_aliases(sql: str) -> Tuple[Dict[str, Tuple[str, str]], Optional[str]]:
+    """alias -> (schema, table) de FROM/JOIN, y el alias de la primera tabla en FROM."""
+    alias_map: Dict[str, Tuple[str, str]] = {}
+    first_from_alias: Optional[str] = None
+    for m in ALIAS_RE.finditer(sql):
+        alias_map[m.group(4)] = (m.group(2), m.group(3))
+        if first_from_alias is None and m.group(1).lower() == "from":
+            first_from_alias = m.group(4)
+    return alias_map, first_from_alias
+
+# Hints por (schema, table) memoizados: el catálogo sólo cambia al recargarlo
+@lru_cache(maxsize=4096)
+def _cache_get_table(schema: str, table: str):
+    return cache_get_table(schema, table)
+
+@lru_cache(maxsize=4096)
 def _srid_for(schema: str, table: str) -> Optional[int]:
-    ti = cache_get_table(schema, table)
+    ti = _cache_get_table(schema, table)
     return ti.geom.srid if ti and ti.geom else None
 
+@lru_cache(maxsize=4096)
 def _geom_for(schema: str, table: str) -> Optional[str]:
-    ti = cache_get_table(schema, table)
+    ti = _cache_get_table(schema, table)
     return preferred_geom(ti) if ti else None
 
+@lru_cache(maxsize=4096)
 def _id_for(schema: str, table: str) -> Optional[str]:
-    ti = cache_get_table(schema, table)
+    ti = _cache_get_table(schema, table)
     return suggest_id_column(ti) if ti else None
 
-def _mentions_metric_units(text: str) -> bool:
-    q = (text or "").lower()
-    return any(w in q for w in (" metro", " metros", " m ", " km", "kilometro", "kilómetro", "kilometros", "kilómetros"))
+for _fn in (_cache_get_table, _srid_for, _geom_for, _id_for):
+    on_reload(_fn.cache_clear)
+
+# Unidades pedidas en la pregunta: se tokeniza una vez y se compara por conjunto
+_WORD_RE = re.compile(r"[a-záéíóúüñ]+")
+_METRIC_TOKENS = frozenset({
+    "m", "metro", "metros", "km", "kms", "kilometro", "kilómetro", "kilometros", "kilómetros",
+})
+_HA_TOKENS = frozenset({"ha", "hectarea", "hectárea", "hectareas", "hectáreas"})
+
+def _tokens(text: str) -> frozenset:
+    return frozenset(_WORD_RE.findall((text or "").lower()))
+
+def _mentions_metric_units(toks: frozenset) -> bool:
+    return not _METRIC_TOKENS.isdisjoint(toks)
 
-def _mentions_hectares(text: str) -> bool:
-    q = (text or "").lower()
-    return any(w in q for w in ("hectarea", "hectárea", "hectareas", "hectáreas", " ha", " en ha", " en hectá"))
+def _mentions_hectares(toks: frozenset) -> bool:
+    return not _HA_TOKENS.isdisjoint(toks)
 
-def _build_table_meta(question: str, sql: str) -> Tuple[
+def _ident_key(ident: exp.Expression) -> str:
+    """Nombre como lo ve Postgres: sin comillas se pliega a minúsculas, con comillas es literal."""
+    name = ident.name
+    return name if isinstance(ident, exp.Identifier) and ident.quoted else name.lower()
+
+def _cte_names(ast: exp.Expression) -> Set[str]:
+    """Nombres de las CTE (WITH ...): tapan a las tablas del catálogo con el mismo nombre."""
+    return {_ident_key(cte.args["alias"].this) for cte in ast.find_all(exp.CTE) if cte.args.get("alias")}
+
+def _unqualified_tables(tbl: exp.Table, ctes: Set[str]) -> Tuple[Tuple[str, str], ...]:
+    """(schema, table) del catálogo para una tabla sin schema, o () si es una CTE."""
+    key = _ident_key(tbl.this)
+    return () if key in ctes else find_tables_by_name(key)
+
+def _ast_table_refs(ast: exp.Expression, ctes: Set[str]) -> List[Tuple[str, str]]:
+    """
+    Tablas (schema, table) del AST; las no calificadas se buscan por nombre exacto en el
+    catálogo, salvo que sean CTE.
+    """
+    refs: List[Tuple[str, str]] = []
+    for tbl in ast.find_all(exp.Table):
+        if not tbl.name:
+            continue
+        if tbl.db:
+            refs.append((tbl.db, tbl.name))
+        else:
+            refs.extend(_unqualified_tables(tbl, ctes))
+    return refs
+
+def _ast_aliases(ast: exp.Expression) -> Tuple[Dict[str, Tuple[str, str]], Optional[str]]:
+    """
+    Como _collect_aliases pero desde el AST: cubre FROM con comas, tablas sin schema
+    (por nombre exacto en el catálogo, si no es ambiguo ni una CTE) y alias que el regex
+    confunde con palabras clave. La tabla 'grande' es la del FROM de la consulta principal.
+    """
+    ctes = _cte_names(ast)
+    alias_map: Dict[str, Tuple[str, str]] = {}
+    for tbl in ast.find_all(exp.Table):
+        if not tbl.alias or not tbl.name:
+            continue
+        if tbl.db:
+            alias_map[tbl.alias] = (tbl.db, tbl.name)
+        else:
+            hits = _unqualified_tables(tbl, ctes)
+            if len(hits) == 1:
+                alias_map[tbl.alias] = hits[0]
+    main_from = ast.find(exp.From)  # BFS: el FROM menos anidado
+    first = main_from.this if main_from is not None else None
+    first_from_alias = first.alias or None if isinstance(first, exp.Table) else None
+    return alias_map, first_from_alias
+
+def _build_table_meta(question: str, sql: str, ast: Optional[exp.Expression] = None) -> Tuple[
     Dict[Tuple[str, str], Dict[str, Optional[str]]],  # meta por (schema, table)
     Dict[str, Tuple[str, str]],                       # nombre_de_tabla_simple -> (schema, table) si no ambiguo
 ]:
     """
-    Usa find_table_refs sobre pregunta y SQL para construir:
+    Usa find_table_refs sobre la pregunta y el SQL (o las tablas del AST si viene) para construir:
     - meta[(schema, table)] = { 'id':.., 'geom':.., 'srid':.. }
     - simple_map['table'] = (schema, table) sólo si el nombre de tabla no es ambiguo
     """
-    refs: Set[Tuple[str, str]] = set()
-    for s, t in find_table_refs(question or ""):
-        refs.add((s, t))
-    for s, t in find_table_refs(sql or ""):
-        refs.add((s, t))
+    # Pregunta y SQL se escanean por separado: find_table_refs está memoizado por texto
+    # (la pregunta ya se vio en build_schema_ctx) y concatenarlos dejaría que la frase
+    # "esquema X ... tabla Y" cruzara de un texto al otro
+    refs: Set[Tuple[str, str]] = set(find_table_refs(question or ""))
+    # EXPLAIN (y lo que sqlglot no entiende) llega como exp.Command, sin nodos Table:
+    # para esos se escanea el texto como si no hubiera AST
+    if not isinstance(ast, exp.Query):
+        ast = None
+    ctes = (
+        _cte_names(ast) if ast is not None
+        else {m.group(1).lower() for m in CTE_NAME_RE.finditer(sql or "")}
+    )
+    # sin AST, del texto SQL sólo salen tablas calificadas: un nombre suelto puede ser una CTE
+    refs.update(
+        _ast_table_refs(ast, ctes) if ast is not None else find_table_refs(sql or "", bare_names=False)
+    )
 
     meta: Dict[Tuple[str, str], Dict[str, Optional[str]]] = {}
     # Para detectar ambigüedad de nombres sin schema
@@ -77,7 +183,7 @@ def _build_table_meta(question: str, sql: str) -> Tuple[
 
     simple_map: Dict[str, Tuple[str, str]] = {}
     for s, t in refs:
-        ti = cache_get_table(s, t)
+        ti = _cache_get_table(s, t)
         if not ti:
             continue
         meta[(s, t)] = {
@@ -85,12 +191,13 @@ def _build_table_meta(question: str, sql: str) -> Tuple[
             "geom": _geom_for(s, t),
             "srid": str(_srid_for(s, t) or "")
         }
-        if names_count.get(t, 0) == 1:
+        # una CTE con el mismo nombre tapa a la tabla: "nombre.col" no es de la tabla
+        if names_count.get(t, 0) == 1 and t.lower() not in ctes:
             simple_map[t] = (s, t)
 
     return meta, simple_map
 
-def fix_sql(sql: str, question: str) -> Tuple[str, List[str]]:
+def fix_sql(sql: str, question: str, ast: Optional[exp.Expression] = None) -> Tuple[str, List[str]]:
     """
     Arregla automáticamente:
     - alias.id / alias.geom -> columnas reales según catálogo
@@ -98,83 +205,84 @@ def fix_sql(sql: str, question: str) -> Tuple[str, List[str]]:
     - table.id / table.geom (sin schema) -> idem si el nombre no es ambiguo
     - ST_DWithin / ST_Intersects: armoniza SRID; si pides metros/km -> normaliza a EPSG:32719
     - ST_Area(...): si pides hectáreas -> transforma a EPSG:32719 y divide entre 10000
+
+    `ast` (opcional, de safeguards.sql_parser.parse_sql) evita re-escanear el SQL para hallar tablas.
     """
-    fixes: List[str] = []
+    # mensajes sin duplicados, en orden de aparición (dict como conjunto ordenado)
+    fixes: Dict[str, None] = {}
     out = sql
 
+    # Filtro barato: sin referencias .id/.geom* ni ST_* que reescribir no hay nada que hacer
+    # (ni catálogo ni regex)
+    low = out.lower()
+    need_col = ".id" in low or ".geom" in low
+    need_st = "st_dwithin" in low or "st_intersects" in low
+    toks = _tokens(question)
+    want_metric = _mentions_metric_units(toks)
+    want_hectares = _mentions_hectares(toks)
+    need_area = want_hectares and "st_area" in low
+    if not (need_col or need_st or need_area):
+        return out, []
+
     # 0) Metadatos por tablas (desde pregunta y/sql)
-    table_meta, simple_map = _build_table_meta(question, out)
-
-    # 1) Alias map
-    alias_map = _collect_aliases(out)
-
-    # 2) Sustitución por alias (a.id / a.geom)
-    for alias, (sch, tab) in alias_map.items():
-        id_hint = table_meta.get((sch, tab), {}).get("id") or _id_for(sch, tab)
-        geom_hint = table_meta.get((sch, tab), {}).get("geom") or _geom_for(sch, tab)
-
-        if id_hint and re.search(rf"\b{alias}\.id\b", out):
-            out = re.sub(rf"\b({alias})\.id\b", rf"\1.{id_hint}", out)
-            fixes.append(f"{alias}.id -> {alias}.{id_hint}")
-
-        if geom_hint and re.search(rf"\b{alias}\.(geom|geometry|geometria)\b", out, flags=re.IGNORECASE):
-            out = re.sub(rf"\b({alias})\.(geom|geometry|geometria)\b", rf"\1.{geom_hint}", out, flags=re.IGNORECASE)
-            fixes.append(f"{alias}.geom -> {alias}.{geom_hint}")
-
-    # 3) Sustitución por referencia totalmente calificada schema.table.id / .geom
-    #    (esto cubre SQL que no usa alias en algunas expresiones)
-    for (sch, tab), meta in table_meta.items():
-        id_hint = meta.get("id")
-        geom_hint = meta.get("geom")
-        if id_hint:
-            pattern = re.compile(rf"\b{re.escape(sch)}\.{re.escape(tab)}\.id\b")
-            if pattern.search(out):
-                out = pattern.sub(f"{sch}.{tab}.{id_hint}", out)
-                fixes.append(f"{sch}.{tab}.id -> {sch}.{tab}.{id_hint}")
-        if geom_hint:
-            pattern = re.compile(rf"\b{re.escape(sch)}\.{re.escape(tab)}\.(geom|geometry|geometria)\b", re.IGNORECASE)
-            if pattern.search(out):
-                out = pattern.sub(f"{sch}.{tab}.{geom_hint}", out)
-                fixes.append(f"{sch}.{tab}.geom -> {sch}.{tab}.{geom_hint}")
-
-    # 4) Sustitución por nombre de tabla sin schema (sólo si no ambiguo)
-    for tbl, (sch, tab) in simple_map.items():
-        meta = table_meta.get((sch, tab), {})
-        id_hint = meta.get("id")
-        geom_hint = meta.get("geom")
-        if id_hint:
-            pattern = re.compile(rf"\b{re.escape(tbl)}\.id\b")
-            if pattern.search(out):
-                out = pattern.sub(f"{tbl}.{id_hint}", out)
-                fixes.append(f"{tbl}.id -> {tbl}.{id_hint}")
-        if geom_hint:
-            pattern = re.compile(rf"\b{re.escape(tbl)}\.(geom|geometry|geometria)\b", re.IGNORECASE)
-            if pattern.search(out):
-                out = pattern.sub(f"{tbl}.{geom_hint}", out)
-                fixes.append(f"{tbl}.geom -> {tbl}.{geom_hint}")
-
-    # 5) Unidades solicitadas
-    want_metric = _mentions_metric_units(question)
-    want_hectares = _mentions_hectares(question)
-
-    # 6) Identificar alias de la primera tabla en FROM (intento de tabla 'grande')
-    first_from_alias = None
-    mfirst = ALIAS_FROM_RE.search(out)
-    if mfirst:
-        first_from_alias = mfirst.group(3)
+    table_meta, simple_map = _build_table_meta(question, out, ast)
+
+    # 1) Alias map (del AST si es una consulta; EXPLAIN llega como exp.Command → regex)
+    alias_map, first_from_alias = (
+        _ast_aliases(ast) if isinstance(ast, exp.Query) else _collect_aliases(out)
+    )
+
+    # 2-4) alias.id / alias.geom, schema.table.id / .geom y table.id / .geom (sin schema,
+    #      sólo si no es ambiguo), resueltos en una sola pasada
+    alias_ci = {a.lower(): st for a, st in alias_map.items()}
+
+    def _hint(st: Tuple[str, str], kind: str) -> Optional[str]:
+        hint = table_meta.get(st, {}).get(kind)
+        if hint:
+            return hint
+        return _id_for(*st) if kind == "id" else _geom_for(*st)
+
+    def _fix_col_ref(m: re.Match) -> str:
+        sch, name = m.group(1), m.group(2)
+        kind = "id" if m.group(3) == "id" else "geom"
+        if sch:
+            prefix, hint = f"{sch}.{name}", _hint((sch, name), kind)
+        elif name in alias_map or name.lower() in alias_ci:
+            prefix, hint = name, _hint(alias_map.get(name) or alias_ci[name.lower()], kind)
+        elif name in simple_map:
+            prefix, hint = name, table_meta.get(simple_map[name], {}).get(kind)
+        else:
+            return m.group(0)
+        if not hint:
+            return m.group(0)
+        fixes[f"{prefix}.{kind} -> {prefix}.{hint}"] = None
+        return f"{prefix}.{hint}"
+
+    if need_col:
+        out = COL_REF_RE.sub(_fix_col_ref, out)
+
+    # 5) Unidades solicitadas: calculadas al inicio (toks / want_metric / want_hectares)
+
+    # 6) El alias de la primera tabla en FROM (intento de tabla 'grande') sale del paso 1
+
+    # Mismo (alias, col, srid) en varias llamadas ST_* → se reutiliza el mismo texto
+    wrap_cache: Dict[Tuple[str, str, Optional[int]], str] = {}
 
     def _wrap_transform(alias: str, col: str, target_srid: Optional[int]) -> str:
-        if not target_srid:
-            return f"{alias}.{col}"
-        return f"ST_Transform({alias}.{col},{target_srid})"
+        key = (alias, col, target_srid)
+        hit = wrap_cache.get(key)
+        if hit is None:
+            hit = f"ST_Transform({alias}.{col},{target_srid})" if target_srid else f"{alias}.{col}"
+            wrap_cache[key] = hit
+        return hit
 
     # Resolver expr → (schema, table, alias, column)
     def _resolve_expr(expr: str) -> Optional[Tuple[str, str, Optional[str], str]]:
         expr = expr.strip()
-        # alias.col
-        m = re.match(r"^([a-zA-Z_][a-zA-Z0-9_]*)\.([a-zA-Z_][a-zA-Z0-9_]*)$", expr)
-        if m:
-            alias, col = m.group(1), m.group(2)
+        # alias.col / schema.table.col con split (forma dominante, sin regex)
+        parts = expr.split(".")
+        if len(parts) == 2 and parts[0].isidentifier() and parts[1].isidentifier():
+            alias, col = parts
             if alias in alias_map:
                 s, t = alias_map[alias]
                 return (s, t, alias, col)
@@ -183,7 +291,10 @@ def fix_sql(sql: str, question: str) -> Tuple[str, List[str]]:
                 s, t = simple_map[alias]
                 return (s, t, None, col)
             return None
-        # schema.table.col
+        if len(parts) == 3 and all(p.isidentifier() for p in parts):
+            s, t, col = parts
+            return (s, t, None, col)
+        # schema.table.col con nombres que no son identificadores simples (p. ej. 2024_x)
         m = QUAL_COL_RE.match(expr)
         if m:
             s, t, col = m.group(1), m.group(2), m.group(3)
@@ -198,7 +309,7 @@ def fix_sql(sql: str, question: str) -> Tuple[str, List[str]]:
         rest = match.group(4) or ""
 
         # respetar si ya hay ST_Transform explícito
-        if re.search(r"ST_Transform\s*\(", arg1, re.IGNORECASE) or re.search(r"ST_Transform\s*\(", arg2, re.IGNORECASE):
+        if ST_TRANSFORM_RE.search(arg1) or ST_TRANSFORM_RE.search(arg2):
             return match.group(0)
 
         r1 = _resolve_expr(arg1)
@@ -210,46 +321,44 @@ def fix_sql(sql: str, question: str) -> Tuple[str, List[str]]:
         s2, t2, a2, c2 = r2
         srid1 = int(table_meta.get((s1, t1), {}).get("srid") or 0) or _srid_for(s1, t1)
         srid2 = int(table_meta.get((s2, t2), {}).get("srid") or 0) or _srid_for(s2, t2)
+        # alias si lo hay; si no, schema.table (la columna va calificada igual)
+        q1, q2 = a1 or f"{s1}.{t1}", a2 or f"{s2}.{t2}"
 
         if want_metric:
             target = METRIC_SRID
             # no transformes la tabla grande (first_from_alias) si aplica
             tx1 = None if (a1 and a1 == first_from_alias) else (target if srid1 != target else None)
             tx2 = None if (a2 and a2 == first_from_alias) else (target if srid2 != target else None)
-            new1 = _wrap_transform(a1 or f"{s1}.{t1}", c1, tx1) if a1 else (f"ST_Transform({s1}.{t1}.{c1},{target})" if tx1 else f"{s1}.{t1}.{c1}")
-            new2 = _wrap_transform(a2 or f"{s2}.{t2}", c2, tx2) if a2 else (f"ST_Transform({s2}.{t2}.{c2},{target})" if tx2 else f"{s2}.{t2}.{c2}")
-            fixes.append(f"{func}: normalizado a EPSG:{target} (metros/km)")
+            new1 = _wrap_transform(q1, c1, tx1)
+            new2 = _wrap_transform(q2, c2, tx2)
+            fixes[f"{func}: normalizado a EPSG:{target} (metros/km)"] = None
             return f"{func}({new1}, {new2}{rest})"
 
         # Si no pides metros: unificar al SRID del lado 'grande' (primer FROM)
         if srid1 and srid2 and srid1 != srid2:
             if a1 and a1 == first_from_alias:
-                new1 = f"{a1}.{c1}"
-                new2 = _wrap_transform(a2 or f"{s2}.{t2}", c2, srid1) if a2 else f"ST_Transform({s2}.{t2}.{c2},{srid1})"
+                new1 = _wrap_transform(q1, c1, None)
+                new2 = _wrap_transform(q2, c2, srid1)
             elif a2 and a2 == first_from_alias:
-                new1 = _wrap_transform(a1 or f"{s1}.{t1}", c1, srid2) if a1 else f"ST_Transform({s1}.{t1}.{c1},{srid2})"
-                new2 = f"{a2}.{c2}"
+                new1 = _wrap_transform(q1, c1, srid2)
+                new2 = _wrap_transform(q2, c2, None)
             else:
                 # por consistencia, transformar arg2 al srid de arg1
-                new1 = f"{a1}.{c1}" if a1 else f"{s1}.{t1}.{c1}"
-                new2 = _wrap_transform(a2 or f"{s2}.{t2}", c2, srid1) if a2 else f"ST_Transform({s2}.{t2}.{c2},{srid1})"
-            fixes.append(f"{func}: unificados SRIDs por consistencia")
+                new1 = _wrap_transform(q1, c1, None)
+                new2 = _wrap_transform(q2, c2, srid1)
+            fixes[f"{func}: unificados SRIDs por consistencia"] = None
             return f"{func}({new1}, {new2}{rest})"
 
         return match.group(0)
 
-    out = re.sub(
-        r"\b(ST_DWithin|ST_Intersects)\s*\(\s*([^,]+)\s*,\s*([^,]+)\s*(,\s*[^)]+)?\)",
-        _fix_st_geom_pair,
-        out,
-        flags=re.IGNORECASE,
-    )
+    if need_st:
+        out = ST_PAIR_RE.sub(_fix_st_geom_pair, out)
 
     # 8) Áreas → hectáreas (ST_Area(...)/10000)
-    if want_hectares:
+    if need_area:
         def _fix_area(ma: re.Match) -> str:
             inner = ma.group(1).strip()
-            if re.search(r"ST_Transform\s*\(", inner, re.IGNORECASE):
+            if ST_TRANSFORM_RE.search(inner):
                 # ya transformado: solo divide
                 return f"({ma.group(0)})/10000.0"
             r = _resolve_expr(inner)
@@ -258,13 +367,13 @@ def fix_sql(sql: str, question: str) -> Tuple[str, List[str]]:
             s, t, a, c = r
             if a and a == first_from_alias:
                 # no toques la 'grande'
-                expr = f"{a}.{c}"
+                expr = _wrap_transform(a, c, None)
             else:
                 # transforma al SRID métrico
-                expr = f"ST_Transform({(a + '.' + c) if a else f'{s}.{t}.{c}'},{METRIC_SRID})"
-            fixes.append(f"ST_Area: convertido a hectáreas en EPSG:{METRIC_SRID}")
+                expr = _wrap_transform(a or f"{s}.{t}", c, METRIC_SRID)
+            fixes[f"ST_Area: convertido a hectáreas en EPSG:{METRIC_SRID}"] = None
             return f"ST_Area({expr})/10000.0"
 
-        out = re.sub(r"\bST_Area\s*\(\s*([^)]+)\s*\)", _fix_area, out, flags=re.IGNORECASE)
+        out = ST_AREA_RE.sub(_fix_area, out)
 
-    return out, fixes
+    return out, list(fixes)
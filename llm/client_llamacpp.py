@@ -1,7 +1,10 @@
 # llm/client_llamacpp.py
 from __future__ import annotations
+import logging
+import os
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple, Union
 from llama_cpp import Llama
 from core.config import settings
 
@@ -9,10 +12,28 @@ from core.config import settings
 _llm_sql: Optional[Llama] = None
 _llm_chat_local: Optional[Llama] = None
 
+# Generación (decode) limitada por memoria: ~núcleos físicos rinden más que todos los
+# hilos lógicos. El prefill usa n_threads_batch (por defecto todos los núcleos).
+N_THREADS = max(1, (os.cpu_count() or 2) // 2)
+# Tokens por lote en el prefill del prompt
+N_BATCH = 512
+
+# Evita construir dos veces el modelo si la carga anticipada y una petición coinciden
+_load_lock = threading.Lock()
+
+# Llama no es thread-safe: serializa el uso del modelo SQL (estado KV compartido)
+_sql_lock = threading.Lock()
+# (prefijo, tokens, split_ok) del preámbulo estático del prompt SQL, tokenizado una vez
+_sql_prefix_tokens: Optional[Tuple[str, List[int], bool]] = None
+
 def get_llm_sql() -> Llama:
     """Devuelve el modelo local (GGUF) para generación de SQL: SQLCoder."""
     global _llm_sql
-    if _llm_sql is None:
+    if _llm_sql is not None:
+        return _llm_sql
+    with _load_lock:
+        if _llm_sql is not None:
+            return _llm_sql
         model_path = getattr(settings, "SQL_MODEL_FILE", None) or getattr(settings, "MODEL_SQL_PATH", None)
         if not model_path:
             raise RuntimeError("No se encontró la ruta del modelo SQL (SQL_MODEL_FILE / MODEL_SQL_PATH).")
@@ -21,11 +42,24 @@ def get_llm_sql() -> Llama:
         _llm_sql = Llama(
             model_path=model_path,
             n_ctx=8192,
-            n_threads=8,   # ajusta a tus CPUs
+            n_batch=N_BATCH,
+            n_threads=N_THREADS,
+            use_mmap=True,     # pesos GGUF mapeados, compartidos por el page cache
+            use_mlock=False,
             verbose=False,
         )
     return _llm_sql
 
+def _eager_load() -> None:
+    try:
+        get_llm_sql()
+    except Exception as e:
+        # no rompe el arranque: la primera petición reintenta y reporta el error
+        logging.getLogger(__name__).warning("Carga anticipada del modelo SQL falló: %s", e)
+
+if settings.EAGER_LOAD_LLM:
+    threading.Thread(target=_eager_load, name="llm-sql-load", daemon=True).start()
+
 def get_llm_chat() -> Optional[Llama]:
     """
     Devuelve un modelo local de chat SÓLO si MODEL_CHAT_PATH está definido y existe.
@@ -41,15 +75,63 @@ def get_llm_chat() -> Optional[Llama]:
             _llm_chat_local = Llama(
                 model_path=model_chat_path,
                 n_ctx=4096,
-                n_threads=8,
+                n_batch=N_BATCH,
+                n_threads=N_THREADS,
+                use_mmap=True,
                 verbose=False,
             )
             return _llm_chat_local
     # No hay modelo local de chat → se usará Ollama en infer_chat()
     return None
 
-def infer_sql(prompt: str) -> str:
-    out = get_llm_sql()(prompt=prompt, max_tokens=512, temperature=0.1, stop=["```"])
+# Ancla para tokenizar un sufijo como continuación: SPM (vocab llama, p. ej. sqlcoder-7b-2)
+# antepone un espacio al inicio de cada texto ("x" → "▁x"); con el ancla delante ese
+# espacio cae antes del salto de línea y sus tokens se descartan
+_SUFFIX_ANCHOR = b"\n"
+
+def _tokenize_suffix(llm: Llama, text: bytes) -> List[int]:
+    """Tokens de `text` tal como quedan detrás de otro texto (sin BOS ni espacio de SPM)."""
+    anchor = llm.tokenize(_SUFFIX_ANCHOR, add_bos=False, special=True)
+    tokens = llm.tokenize(_SUFFIX_ANCHOR + text, add_bos=False, special=True)
+    if tokens[:len(anchor)] != anchor:
+        # el ancla se fusionó con el texto: no hay corte limpio
+        return llm.tokenize(text, add_bos=False, special=True)
+    return tokens[len(anchor):]
+
+def _prefix_tokens(llm: Llama, static_prefix: str) -> Tuple[List[int], bool]:
+    """
+    Tokens del preámbulo estático (con BOS), calculados una sola vez. El KV-cache no
+    se guarda aparte: Llama.generate ya reutiliza el prefijo común con la llamada
+    anterior y _sql_lock impide que otra evaluación se intercale.
+
+    Devuelve también si se pueden concatenar con los del sufijo tokenizado aparte
+    sin cambiar la tokenización del texto completo.
+    """
+    global _sql_prefix_tokens
+    if _sql_prefix_tokens is None or _sql_prefix_tokens[0] != static_prefix:
+        tokens = llm.tokenize(static_prefix.encode("utf-8"), add_bos=True, special=True)
+        # BPE puede fusionar en el borde: se comprueba una vez con una palabra de prueba
+        probe = llm.tokenize((static_prefix + "x").encode("utf-8"), add_bos=True, special=True)
+        split_ok = probe == tokens + _tokenize_suffix(llm, b"x")
+        _sql_prefix_tokens = (static_prefix, tokens, split_ok)
+    _, tokens, split_ok = _sql_prefix_tokens
+    return tokens, split_ok
+
+def infer_sql(prompt: str, static_prefix: str = "") -> str:
+    """
+    Genera SQL para `static_prefix + prompt`. Si se indica `static_prefix` (preámbulo fijo,
+    ver llm.prompts.build_sql_prompt_parts), sus tokens se reutilizan entre llamadas y
+    Llama.generate conserva su KV-cache: sólo se tokeniza y evalúa `prompt`.
+    """
+    llm = get_llm_sql()
+    with _sql_lock:
+        full_prompt: Union[str, List[int]] = static_prefix + prompt
+        if static_prefix:
+            prefix_tokens, split_ok = _prefix_tokens(llm, static_prefix)
+            if split_ok and prompt and not prompt[0].isspace():
+                # prompt como lista de tokens: llama-cpp no agrega BOS (ya va en el prefijo)
+                full_prompt = prefix_tokens + _tokenize_suffix(llm, prompt.encode("utf-8"))
+        out = llm(prompt=full_prompt, max_tokens=512, temperature=0.1, stop=["```"])
     return out["choices"][0]["text"].strip()
 
 def infer_chat(prompt: str) -> str:
@@ -1,19 +1,42 @@
 # llm/client_ollama.py
 import os, requests
+import orjson
+from requests.adapters import HTTPAdapter
 from core.config import settings
 
 # Permite override por variable de entorno o usa lo del config.py
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST", settings.OLLAMA_HOST)
 CHAT_MODEL  = os.environ.get("OLLAMA_CHAT_MODEL", settings.OLLAMA_CHAT_MODEL)
 
+# Sesión compartida: conexiones keep-alive reutilizadas entre llamadas
+# (infer_chat corre en hilos vía asyncio.to_thread; el pool es thread-safe)
+_SESSION = requests.Session()
+_SESSION.headers["Content-Type"] = "application/json"
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
+
 def _gen(model: str, prompt: str, **kw):
+    """
+    Llama a /api/generate en modo streaming (NDJSON) y acumula los fragmentos a medida
+    que llegan, en vez de esperar a que Ollama arme la respuesta completa.
+    """
     url = f"{OLLAMA_HOST}/api/generate"
-    payload = {"model": model, "prompt": prompt, "stream": False}
+    payload = {"model": model, "prompt": prompt, "stream": True}
     payload.update(kw)
-    r = requests.post(url, json=payload, timeout=600)
-    r.raise_for_status()
-    data = r.json()
-    return data.get("response", "").strip()
+    buf = []
+    with _SESSION.post(url, data=orjson.dumps(payload), stream=True, timeout=600) as r:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if not line:
+                continue
+            obj = orjson.loads(line)
+            if "error" in obj:
+                raise RuntimeError(f"Ollama: {obj['error']}")
+            buf.append(obj.get("response", ""))
+            if obj.get("done"):
+                break
+    return "".join(buf).strip()
 
 def infer_chat(prompt: str) -> str:
     # respuesta breve en español
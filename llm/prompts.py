@@ -12,14 +12,21 @@ Reglas:
 - Nunca inventes columnas como id, nombre, geom; usa las provistas en el Contexto.
 """
 
-def build_sql_prompt(question: str, schema_ctx: str = "") -> str:
-    return f"""{SQL_SYSTEM}
+# Preámbulo fijo del prompt SQL: su KV-cache se reutiliza entre llamadas (ver infer_sql)
+SQL_PREFIX = f"""{SQL_SYSTEM}
 
 Contexto:
-{schema_ctx}
+"""
+
+def build_sql_prompt_parts(question: str, schema_ctx: str = "") -> tuple[str, str]:
+    """Devuelve (prefijo_estático, sufijo_dinámico) del prompt SQL."""
+    return SQL_PREFIX, f"""{schema_ctx}
 
 Usuario:
 {question}
 
 Responde SOLO:
 """
+
+def build_sql_prompt(question: str, schema_ctx: str = "") -> str:
+    return "".join(build_sql_prompt_parts(question, schema_ctx))
@@ -1,68 +1,105 @@
 # safeguards/sql_parser.py
+import re
+from collections import OrderedDict
+from typing import Optional, Tuple
 import sqlglot
-from sqlglot.expressions import Select, With
+from sqlglot.expressions import Expression, Select, With
 
 # Permitimos solo SELECT/WITH (y EXPLAIN de esos mismos)
 ALLOW = (Select, With)
 
 BLOCK_KW = (
-    " drop ", " truncate ", " alter ", " delete ", " update ", " insert ",
-    " create table ", " create schema ", " create index ", " grant ", " revoke ",
-    " vacuum ", " analyze ", " copy ", " call ", " do "
+    "drop", "truncate", "alter", "delete", "update", "insert",
+    "create table", "create schema", "create index", "grant", "revoke",
+    "vacuum", "analyze", "copy", "call", "do"
 )
 
-def is_safe_sql(sql: str) -> tuple[bool, str]:
+# Una sola pasada sobre el SQL original (sin .lower() ni padding): palabra clave
+# delimitada por espacios en blanco o por los bordes del texto, como el " kw " anterior.
+_BLOCK_RE = re.compile(
+    r"(?<!\S)(" + "|".join(kw.replace(" ", r"\s+") for kw in BLOCK_KW) + r")(?!\S)",
+    re.IGNORECASE,
+)
+
+# Prefijo de EXPLAIN con sus opciones: lo que sigue es la consulta a validar
+_EXPLAIN_RE = re.compile(
+    r"^\s*explain\b\s*(?:\([^)]*\)\s*)?(?:analyze\s+)?(?:verbose\s+)?",
+    re.IGNORECASE,
+)
+
+def _blocked_keyword(sql: str) -> Optional[str]:
+    """Primera keyword bloqueada en `sql` (en mayúsculas), o None."""
+    m = _BLOCK_RE.search(sql)
+    return " ".join(m.group(1).split()).upper() if m else None
+
+# Veredictos memoizados por SQL (sin espacios extremos ni ';' final): reintentos y
+# SQL repetidos no vuelven a pasar por sqlglot. No dependen del catálogo.
+SAFE_CACHE_SIZE = 1024
+_safe_cache: "OrderedDict[str, Tuple[bool, str]]" = OrderedDict()
+
+def parse_sql(sql: str) -> Optional[Expression]:
+    """
+    AST de sqlglot (dialecto postgres) de la sentencia, o None si no se puede parsear.
+    Se parsea una vez por request y el AST se comparte entre validación, fixup y LIMIT.
+    """
+    try:
+        return sqlglot.parse_one(sql.strip().rstrip(";"), read="postgres")
+    except sqlglot.errors.SqlglotError:
+        return None
+
+def is_safe_sql(sql: str, ast: Optional[Expression] = None) -> tuple[bool, str]:
     """
     Valida que la sentencia sea SELECT/WITH o EXPLAIN de una de esas.
     Usa sqlglot para parsear el AST sin depender de la clase Explain (que no siempre existe).
+    Si se entrega `ast` (de parse_sql) no se vuelve a parsear; el veredicto se memoiza por texto.
     """
     if not sql or not sql.strip():
         return False, "SQL vacío"
 
     s = sql.strip().rstrip(";")
-    low = s.lower().lstrip()
+    hit = _safe_cache.get(s)
+    if hit is not None:
+        _safe_cache.move_to_end(s)
+        return hit
+
+    verdict = _check_sql(s, ast)
+    _safe_cache[s] = verdict
+    if len(_safe_cache) > SAFE_CACHE_SIZE:
+        _safe_cache.popitem(last=False)
+    return verdict
 
+def _check_sql(s: str, ast: Optional[Expression]) -> Tuple[bool, str]:
     # Si empieza con EXPLAIN, parseamos la parte de detrás para validar que sea SELECT/WITH
-    if low.startswith("explain "):
-        # quita el prefijo "explain" y flags opcionales simples
-        # (manejo básico: si hay EXPLAIN (FORMAT JSON) lo dejamos; solo validamos que la consulta base sea SELECT/WITH)
+    m = _EXPLAIN_RE.match(s)
+    if m:
+        # quita el prefijo "EXPLAIN [(opciones)] [ANALYZE] [VERBOSE]" y parsea la consulta base
         try:
-            # Intenta encontrar el primer "select"/"with" en el string para parsear desde ahí
-            idx_sel = low.find(" select ")
-            idx_with = low.find(" with ")
-            idx = max(idx_sel, idx_with)
-            if idx == -1:
-                # fallback: quitar solo la palabra explain y parsear el resto
-                inner = s.split(None, 1)[1]
-            else:
-                inner = s[idx:].lstrip()
-            ast = sqlglot.parse_one(inner, read="postgres")
+            ast = sqlglot.parse_one(s[m.end():], read="postgres")
         except Exception as e:
             return False, f"Parse error (EXPLAIN): {e}"
 
         if not isinstance(ast, ALLOW):
             return False, "EXPLAIN solo permitido sobre SELECT/WITH"
         # blocklist igualmente
-        low_padded = f" {s.lower()} "
-        for kw in BLOCK_KW:
-            if kw in low_padded:
-                return False, f"Keyword bloqueada: {kw.strip().upper()}"
+        kw = _blocked_keyword(s)
+        if kw:
+            return False, f"Keyword bloqueada: {kw}"
         return True, "OK"
 
     # Caso normal: SELECT/WITH
-    try:
-        ast = sqlglot.parse_one(s, read="postgres")
-    except Exception as e:
-        return False, f"Parse error: {e}"
+    if ast is None:
+        try:
+            ast = sqlglot.parse_one(s, read="postgres")
+        except Exception as e:
+            return False, f"Parse error: {e}"
 
     if not isinstance(ast, ALLOW):
         # Mensaje claro con la clave del nodo
         node = getattr(ast, "key", "").upper() or type(ast).__name__
         return False, f"Solo SELECT/WITH/EXPLAIN permitidos (recibido: {node})"
 
-    low_padded = f" {low} "
-    for kw in BLOCK_KW:
-        if kw in low_padded:
-            return False, f"Keyword bloqueada: {kw.strip().upper()}"
+    kw = _blocked_keyword(s)
+    if kw:
+        return False, f"Keyword bloqueada: {kw}"
 
     return True, "OK"
\ No newline at end of file
@@ -0,0 +1,25 @@
+"""
+Precarga el catálogo de PostGIS una sola vez y lo deja en SCHEMA_CACHE_FILE
+(p. ej. en /dev/shm) para que los workers de uvicorn lo lean al arrancar.
+
+Uso (desde la raíz del repo, con la misma SCHEMA_CACHE_FILE que verán los workers):
+    SCHEMA_CACHE_FILE=/dev/shm/schema_cache.pkl python -m scripts.warm_cache
+"""
+import asyncio
+
+from core.config import ALLOWED_SCHEMAS, settings
+from db.engine import engine
+from db.schema_cache import dump_schema_cache, load_schema_cache
+
+
+async def main() -> None:
+    if not settings.SCHEMA_CACHE_FILE:
+        raise SystemExit("Define SCHEMA_CACHE_FILE (p. ej. /dev/shm/schema_cache.pkl)")
+    await load_schema_cache(ALLOWED_SCHEMAS)
+    await engine.dispose()
+    dump_schema_cache(settings.SCHEMA_CACHE_FILE, ALLOWED_SCHEMAS)
+    print(f"Catálogo guardado en {settings.SCHEMA_CACHE_FILE}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,23 @@
+# tests/conftest.py
+import pytest
+
+from db.schema_cache import ColumnInfo, GeometryInfo, TableInfo, _install_cache
+
+def _table(schema, table, cols, pk=(), geom=None):
+    return TableInfo(
+        schema=schema, table=table,
+        columns=tuple(ColumnInfo(name, dtype, name not in pk, name in pk) for name, dtype in cols),
+        pk_cols=tuple(pk), geom=geom, indexes=(), fks=(),
+    )
+
+@pytest.fixture
+def catalog():
+    """Catálogo mínimo en memoria (sin base de datos): datos_maestros.comunas."""
+    comunas = _table(
+        "datos_maestros", "comunas",
+        [("id_comuna", "integer"), ("nombre", "text"), ("geometria", "USER-DEFINED")],
+        pk=("id_comuna",), geom=GeometryInfo("geometria", 4326, "MULTIPOLYGON"),
+    )
+    _install_cache({(comunas.schema, comunas.table): comunas})
+    yield
+    _install_cache({})
@@ -0,0 +1,23 @@
+# tests/test_sql_fixup.py
+from safeguards.sql_parser import parse_sql
+from db.sql_fixup import _build_table_meta, fix_sql
+
+EXPLAIN_SQL = "EXPLAIN SELECT c.id, c.geom FROM datos_maestros.comunas c"
+
+def test_table_meta_explain_uses_text(catalog):
+    # EXPLAIN se parsea como exp.Command: las tablas salen del texto, no del AST
+    meta, _ = _build_table_meta("", EXPLAIN_SQL, parse_sql(EXPLAIN_SQL))
+    assert meta[("datos_maestros", "comunas")]["id"] == "id_comuna"
+
+def test_fix_sql_explain_with_ast(catalog):
+    # con o sin el AST de parse_sql, el EXPLAIN se corrige igual
+    expected = "EXPLAIN SELECT c.id_comuna, c.geometria FROM datos_maestros.comunas c"
+    assert fix_sql(EXPLAIN_SQL, "", parse_sql(EXPLAIN_SQL))[0] == expected
+    assert fix_sql(EXPLAIN_SQL, "")[0] == expected
+
+def test_fix_sql_cte_shadows_table_without_ast(catalog):
+    # sin AST, una CTE con el nombre de una tabla del catálogo no se reescribe
+    sql = "WITH comunas AS (SELECT 1 AS id) SELECT comunas.id FROM comunas"
+    assert fix_sql(sql, "") == (sql, [])
+    # ni aunque la pregunta nombre la tabla
+    assert fix_sql(sql, "cuántas comunas hay") == (sql, [])
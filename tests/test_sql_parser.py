@@ -0,0 +1,42 @@
+# tests/test_sql_parser.py
+import pytest
+
+from safeguards import sql_parser
+from safeguards.sql_parser import is_safe_sql
+
+@pytest.mark.parametrize("sql", [
+    "CREATE\nTABLE t (id int)",
+    "DELETE\tFROM datos_maestros.comunas",
+    "SELECT 1;\nDELETE\tFROM t",
+])
+def test_blocked_keyword_across_whitespace(sql):
+    ok, _ = is_safe_sql(sql)
+    assert not ok
+
+@pytest.mark.parametrize("sql", [
+    "SELECT updated_at FROM datos_maestros.comunas",
+    "SELECT id FROM datos_maestros.comunas WHERE limit_date > now()",
+])
+def test_identifiers_containing_keywords_allowed(sql):
+    assert is_safe_sql(sql) == (True, "OK")
+
+def test_explain_with_options_allowed():
+    assert is_safe_sql("explain(format json) select 1") == (True, "OK")
+
+@pytest.mark.parametrize("sql", [
+    "EXPLAIN ANALYZE SELECT 1",
+    "EXPLAIN DELETE FROM datos_maestros.comunas",
+])
+def test_explain_rejected(sql):
+    ok, _ = is_safe_sql(sql)
+    assert not ok
+
+def test_verdict_cached_ignoring_whitespace_and_semicolon(monkeypatch):
+    sql = "SELECT nombre FROM datos_maestros.comunas"
+    verdict = is_safe_sql(sql)
+
+    def _no_check(*args):
+        raise AssertionError("no debería volver a validarse")
+
+    monkeypatch.setattr(sql_parser, "_check_sql", _no_check)
+    assert is_safe_sql(f"  {sql};\n") == verdict